@@ -1,108 +1,175 @@
 # app.py
-# Streamlit app: Copione PDF → Editor + Voce istantanea (Web Speech API) + Tap (Python WAV) + Salvataggio
+# Streamlit app: Copione PDF → Editor + Voce istantanea (Web Speech API) + Tap (Python Opus/WAV) + Salvataggio
 # Per-row Play/Stop (dove erano) + Frecce su/giù flottanti fisse in basso a destra
 
 import io
+import html
 import re
-import json
 import os
 import base64
-from typing import List, Dict, Optional, Tuple
+import hashlib
+from collections import namedtuple
+from typing import Iterator, List, Dict, Optional, Tuple
 
+import orjson
 import streamlit as st
 import pdfplumber
 
+import numpy as np
 from pydub import AudioSegment
-from pydub.generators import Sine
+
+# Estrattore veloce opzionale (pypdfium2), altrimenti pdfplumber
+try:
+    import pypdfium2 as pdfium
+    _EXTRACTOR = 'pdfium'
+except ImportError:
+    pdfium = None
+    _EXTRACTOR = 'pdfplumber'
 
 CACHE_PATH = 'script_cache.json'
 
+# Blocchi come liste parallele (personaggi, testi) invece di una lista di dict
+Blocks = namedtuple('Blocks', 'characters texts')
+
 # --------------------------- Parser ---------------------------
 
+_UL_RE = re.compile(r'^_+\s*', re.MULTILINE)
+_UR_RE = re.compile(r'\s*_+$', re.MULTILINE)
+# due punti e spazi in un solo passaggio (gruppo 1 = due punti)
+_PRECLEAN_RE = re.compile(r'(\s*:\s*)|[\t\x0b\x0c\u00A0]+')
+# equivale a line.upper() + startswith/in, senza copiare la riga
+_HEADING_RE = re.compile(r'^SCENA |PERSONAGGI|ANTIPASTO|PRIMI|DOLCI|CAFF', re.IGNORECASE)
+_SPEAKER_RE = re.compile(r"^(?P<who>[A-ZÀ-ÖØ-Þ][A-Za-zÀ-ÖØ-öø-ÿ’' .\-]*(?:\([^)]*\))?)\s*:\s*(?P<what>.*)$")
+_PAREN_RE = re.compile(r'\s*\([^)]*\)\s*')
+_MS_RE = re.compile(r'\s{2,}')
+_STAGE_RE = re.compile(r'^\((?:[^()]|\([^)]*\))*\)\s*')
+
+def _preclean_sub(m: re.Match) -> str:
+    return ': ' if m.lastindex == 1 else ' '
+
 def _preclean_text(text: str) -> str:
-    text = text.replace('\r', '')
-    text = re.sub(r'\*{1,3}', '', text)
-    text = re.sub(r'^_+\s*', '', text, flags=re.MULTILINE)
-    text = re.sub(r'\s*_+$', '', text, flags=re.MULTILINE)
+    text = text.replace('\r', '').replace('*', '')
     text = text.replace('\\(', '(').replace('\\)', ')')
-    text = re.sub(r'\s*:\s*', ': ', text)
-    text = re.sub(r'[\t\x0b\x0c\u00A0]+', ' ', text)
-    return text
+    text = _UL_RE.sub('', text)
+    text = _UR_RE.sub('', text)
+    return _PRECLEAN_RE.sub(_preclean_sub, text)
 
 def _is_section_heading(line: str) -> bool:
-    u = line.upper()
-    return (u.startswith('SCENA ') or 'PERSONAGGI' in u or 'ANTIPASTO' in u or 'PRIMI' in u or 'DOLCI' in u or 'CAFF' in u)
+    return _HEADING_RE.search(line) is not None
 
 def _clean_stage_dirs_start(s: str) -> str:
-    s = re.sub(r'^\((?:[^()]|\([^)]*\))*\)\s*', '', s)
+    s = _STAGE_RE.sub('', s)
     return s.strip()
 
-def parse_script_from_pdf(file_bytes: bytes) -> List[Dict[str, str]]:
+def _iter_pdfium_page_texts(file_bytes: bytes) -> Iterator[str]:
+    pdf = pdfium.PdfDocument(file_bytes)
+    try:
+        for i in range(len(pdf)):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            yield textpage.get_text_range()
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+
+def _iter_page_texts(file_bytes: bytes) -> Iterator[str]:
+    if _EXTRACTOR == 'pdfium':
+        yield from _iter_pdfium_page_texts(file_bytes)
+        return
     with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-        pages = [(p.extract_text() or '') for p in pdf.pages]
-    text = _preclean_text("\n".join(pages))
-    speaker_pat = re.compile(r"^(?P<who>[A-ZÀ-ÖØ-Þ][A-Za-zÀ-ÖØ-öø-ÿ’' .\-]*(?:\([^)]*\))?)\s*:\s*(?P<what>.*)$")
-    blocks: List[Dict[str, str]] = []
+        for p in pdf.pages:
+            yield p.extract_text() or ''
+
+def _append_scene(blocks: Blocks, text: str):
+    # blocchi SCENA consecutivi vengono uniti subito, senza un secondo passaggio
+    if blocks.characters and blocks.characters[-1] == 'SCENA':
+        blocks.texts[-1] = (blocks.texts[-1] + '\n' + text).strip()
+    else:
+        blocks.characters.append('SCENA')
+        blocks.texts.append(text)
+
+# Il risultato in cache è una tupla semplice di liste: st.cache_data lo serializza con
+# pickle e la classe Blocks viene ridefinita a ogni run dello script
+@st.cache_data(max_entries=4, show_spinner=False)
+def _parse_script_lists(file_bytes: bytes) -> Tuple[List[str], List[str]]:
+    blocks = Blocks([], [])
     current_name: Optional[str] = None
     current_lines: List[str] = []
     def flush():
         nonlocal current_name, current_lines
         if current_name and current_lines:
             joined = "\n".join(current_lines).strip()
-            if joined:
-                blocks.append({"character": current_name, "text": joined})
+            if joined and current_name == 'SCENA':
+                _append_scene(blocks, joined)
+            elif joined:
+                blocks.characters.append(current_name)
+                blocks.texts.append(joined)
         current_name, current_lines = None, []
-    for raw_line in text.splitlines():
+    def process_line(raw_line: str):
+        nonlocal current_name, current_lines
         line = raw_line.strip()
         if not line:
             if current_name and current_lines and current_lines[-1] != '':
                 current_lines.append('')
-            continue
+            return
         if _is_section_heading(line):
             flush()
-            blocks.append({"character": "SCENA", "text": line})
-            continue
-        m = speaker_pat.match(line)
+            _append_scene(blocks, line)
+            return
+        # scarto rapido: una battuta inizia in maiuscolo e contiene ':'
+        m = _SPEAKER_RE.match(line) if line[0].isupper() and ':' in line else None
         if m:
             flush()
-            who = re.sub(r'\s*\([^)]*\)\s*', '', m.group('who')).strip()
-            who = re.sub(r'\s{2,}', ' ', who)
+            who = _PAREN_RE.sub('', m.group('who')).strip()
+            who = _MS_RE.sub(' ', who)
             what = _clean_stage_dirs_start(m.group('what'))
             current_name, current_lines = who, ([what] if what else [])
         else:
             if line.startswith('(') and line.endswith(')'):
                 flush()
-                blocks.append({"character": "SCENA", "text": line})
+                _append_scene(blocks, line)
             else:
                 if current_name:
                     line2 = _clean_stage_dirs_start(line)
                     if line2:
                         current_lines.append(line2)
                 else:
-                    blocks.append({"character": "SCENA", "text": line})
+                    _append_scene(blocks, line)
+    # Pagina per pagina: mai tutto il testo in memoria due volte
+    for page_text in _iter_page_texts(file_bytes):
+        # il "\n" finale riproduce la riga vuota che il join tra pagine lasciava
+        for raw_line in (_preclean_text(page_text) + "\n").splitlines():
+            process_line(raw_line)
     flush()
-    compact: List[Dict[str, str]] = []
-    for b in blocks:
-        if compact and b['character'] == 'SCENA' and compact[-1]['character'] == 'SCENA':
-            compact[-1]['text'] = (compact[-1]['text'] + '\n' + b['text']).strip()
-        else:
-            compact.append(b)
-    return compact
+    return blocks.characters, blocks.texts
+
+def parse_script_from_pdf(file_bytes: bytes) -> Blocks:
+    return Blocks(*_parse_script_lists(file_bytes))
 
-# --------------------------- TAP WAV ---------------------------
+# --------------------------- TAP ---------------------------
 
+def _click_tone(sr: int, freq: float, duration_ms: int, volume_db: float, fade_ms: int) -> np.ndarray:
+    n = int(sr * duration_ms / 1000)
+    t = np.arange(n) / sr
+    wave = 32767 * 10 ** (volume_db / 20) * np.sin(2 * np.pi * freq * t)
+    fade = int(sr * fade_ms / 1000)
+    wave[n - fade:] *= np.linspace(1, 0, fade)
+    return wave
+
+@st.cache_resource(max_entries=8, show_spinner=False)
 def generate_keyboard_tap(duration_ms: int = 1800,
                           avg_interval_ms: int = 140,
                           jitter_ms: int = 80,
                           volume_db: float = 0.0) -> AudioSegment:
     sr = 44100
-    track = AudioSegment.silent(duration=duration_ms, frame_rate=sr)
+    n = int(sr * (duration_ms + 120) / 1000)
+    track = np.zeros(n, dtype=np.float64)
     # iPhone/Android keyboard tap: very short, clean, subtle click
-    click_hi = Sine(1400).to_audio_segment(duration=8, volume=volume_db-2).fade_out(5)
-    click_mid = Sine(700).to_audio_segment(duration=10, volume=volume_db-4).fade_out(7)
-    click_lo = Sine(200).to_audio_segment(duration=15, volume=volume_db-8).fade_out(10)
-    click = click_hi.overlay(click_mid).overlay(click_lo)
-    import numpy as np
+    # come overlay() di pydub: il click dura quanto il tono alto (8 ms), mid e lo vengono troncati
+    click = _click_tone(sr, 1400, 8, volume_db-2, 5)
+    click += _click_tone(sr, 700, 10, volume_db-4, 7)[:click.size]
+    click += _click_tone(sr, 200, 15, volume_db-8, 10)[:click.size]
     rng = np.random.default_rng()
     t = 0
     while t < duration_ms:
@@ -110,43 +177,103 @@ def generate_keyboard_tap(duration_ms: int = 1800,
         t += delta
         if t >= duration_ms:
             break
-        track = track.overlay(click, position=t)
-    track += AudioSegment.silent(duration=120, frame_rate=sr)
-    return track
+        off = int(sr * t / 1000)
+        end = min(off + click.size, n)
+        track[off:end] += click[:end - off]
+    pcm = np.clip(track, -32768, 32767).astype(np.int16)
+    return AudioSegment(data=pcm.tobytes(), sample_width=2, frame_rate=sr, channels=1)
+
+def _tap_cache_path(key: str, ext: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(CACHE_PATH)), f'.tap_{key}.{ext}')
+
+def _encode_tap(seg: AudioSegment) -> Tuple[bytes, str]:
+    # Opus a 24 kbit/s (~10x più leggero del WAV); se ffmpeg/libopus manca, WAV 22.05 kHz 8 bit
+    try:
+        buf = io.BytesIO()
+        seg.set_frame_rate(24000).export(buf, format='ogg', codec='libopus', bitrate='24k')
+        return buf.getvalue(), 'ogg'
+    except Exception:
+        buf = io.BytesIO()
+        seg.set_frame_rate(22050).set_sample_width(1).export(buf, format='wav')
+        return buf.getvalue(), 'wav'
 
-def tap_wav_data_uri(duration_ms: int = 1800) -> str:
-    seg = generate_keyboard_tap(duration_ms=duration_ms)
-    buf = io.BytesIO()
-    seg.export(buf, format='wav')
-    b64 = base64.b64encode(buf.getvalue()).decode('ascii')
-    return 'data:audio/wav;base64,' + b64
+@st.cache_data(max_entries=8, show_spinner=False)
+def tap_data_uri(duration_ms: int = 1800,
+                 avg_interval_ms: int = 140,
+                 jitter_ms: int = 80,
+                 volume_db: float = 0.0) -> str:
+    params = (duration_ms, avg_interval_ms, jitter_ms, volume_db)
+    key = hashlib.sha1(repr(('opus', params)).encode('ascii')).hexdigest()[:12]
+    b64_path = _tap_cache_path(key, 'b64.txt')
+    try:
+        with open(b64_path, 'r', encoding='ascii') as f:
+            return f.read()
+    except Exception:
+        pass
+    ogg_path = _tap_cache_path(key, 'ogg')
+    try:
+        with open(ogg_path, 'rb') as f:
+            data, ext = f.read(), 'ogg'
+    except Exception:
+        data, ext = _encode_tap(generate_keyboard_tap(*params))
+    uri = f'data:audio/{ext};base64,' + base64.b64encode(data).decode('ascii')
+    # su disco va solo l'Opus: il WAV di ripiego non deve impedire di riprovare quando ffmpeg c'è
+    if ext == 'ogg':
+        try:
+            with open(ogg_path, 'wb') as f:
+                f.write(data)
+            with open(b64_path, 'w', encoding='ascii') as f:
+                f.write(uri)
+        except Exception:
+            pass
+    return uri
 
 # --------------------------- Cache ---------------------------
 
-def load_cache() -> Tuple[List[Dict[str, str]], List[str]]:
+def _blocks_from_dicts(items: List[Dict[str, str]]) -> Blocks:
+    return Blocks([b['character'] for b in items], [b['text'] for b in items])
+
+def _blocks_to_dicts(blocks: Blocks) -> List[Dict[str, str]]:
+    return [{'character': c, 'text': t} for c, t in zip(blocks.characters, blocks.texts)]
+
+def load_cache() -> Tuple[Blocks, List[str]]:
     if not os.path.exists(CACHE_PATH):
-        return [], []
+        return Blocks([], []), []
     try:
-        with open(CACHE_PATH, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(CACHE_PATH, 'rb') as f:
+            data = orjson.loads(f.read())
         if isinstance(data, list):
-            return data, []
+            return _blocks_from_dicts(data), []
         if isinstance(data, dict):
-            return data.get('blocks', []), data.get('selected_chars', [])
+            return _blocks_from_dicts(data.get('blocks', [])), data.get('selected_chars', [])
     except Exception:
         pass
-    return [], []
+    return Blocks([], []), []
 
-def save_cache(blocks: List[Dict[str, str]], selected_chars: List[str]):
+def save_cache(blocks: Blocks, selected_chars: List[str],
+               last_digest: Optional[str] = None) -> Optional[str]:
+    # Ritorna il digest del contenuto; se coincide con last_digest non riscrive il file
     try:
-        payload = { 'blocks': blocks, 'selected_chars': selected_chars }
-        with open(CACHE_PATH, 'w', encoding='utf-8') as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
+        payload = { 'blocks': _blocks_to_dicts(blocks), 'selected_chars': selected_chars }
+        data = orjson.dumps(payload)
+        digest = hashlib.sha1(data).hexdigest()
+        if digest != last_digest:
+            with open(CACHE_PATH, 'wb') as f:
+                f.write(data)
+        return digest
     except Exception:
-        pass
+        return None
 
 # --------------------------- UI ---------------------------
 
+_PLAY_HTML = "<button data-play data-tap='{}' data-text='{}' style='padding:6px 12px; cursor:pointer; border:1px solid #ccc; border-radius:4px; background:#f0f0f0; min-width:70px;'>Play</button>"
+_BLOCK_HTML = "<div style='white-space:pre-wrap;border:1px solid #ddd;padding:8px;border-radius:6px;background:{}'>{}</div>"
+
+def _render_block(text: str) -> Tuple[str, str, str]:
+    escaped = html.escape(text)
+    return (_BLOCK_HTML.format('#fafafa', escaped), _BLOCK_HTML.format('#fffef8', escaped),
+            html.escape(text, quote=True).replace('\n', '&#10;'))
+
 st.set_page_config(page_title='Copione', layout='wide')
 
 with st.sidebar:
@@ -155,7 +282,8 @@ with st.sidebar:
     colA, colB = st.columns(2)
     with colA:
         if st.button('Salva ora'):
-            save_cache(st.session_state.get('blocks', []), st.session_state.get('selected_chars', []))
+            st.session_state['_saved_digest'] = save_cache(st.session_state.get('blocks', Blocks([], [])), st.session_state.get('selected_chars', []))
+            st.session_state['_dirty'] = False
             st.success('Copione salvato (cache locale).')
     with colB:
         if st.button('Reset cache'):
@@ -163,8 +291,12 @@ with st.sidebar:
                 os.remove(CACHE_PATH)
             except Exception:
                 pass
-            st.session_state['blocks'] = []
+            st.session_state['blocks'] = Blocks([], [])
+            st.session_state['_blocks_version'] = st.session_state.get('_blocks_version', 0) + 1
             st.session_state['selected_chars'] = []
+            st.session_state.pop('sel_multiselect', None)
+            st.session_state.pop('_saved_digest', None)
+            st.session_state.pop('_pdf_sig', None)
             st.success('Cache rimossa.')
 
 # Stato
@@ -172,109 +304,85 @@ if 'blocks' not in st.session_state or 'selected_chars' not in st.session_state:
     blocks_cached, selected_cached = load_cache()
     if 'blocks' not in st.session_state:
         st.session_state['blocks'] = blocks_cached
+        st.session_state['_blocks_version'] = st.session_state.get('_blocks_version', 0) + 1
     if 'selected_chars' not in st.session_state:
         st.session_state['selected_chars'] = selected_cached
 
+# Carica il PDF solo se è nuovo (non già caricato)
 if uploaded_pdf is not None:
-    st.session_state['blocks'] = parse_script_from_pdf(uploaded_pdf.read())
-    st.session_state['selected_chars'] = []
-    save_cache(st.session_state['blocks'], st.session_state['selected_chars'])
+    pdf_bytes = uploaded_pdf.getvalue()
+    pdf_sig = (uploaded_pdf.name, hashlib.blake2b(pdf_bytes, digest_size=8).hexdigest())
+    if st.session_state.get('_pdf_sig') != pdf_sig:
+        st.session_state['blocks'] = parse_script_from_pdf(pdf_bytes)
+        st.session_state['_blocks_version'] = st.session_state.get('_blocks_version', 0) + 1
+        st.session_state['selected_chars'] = []
+        st.session_state.pop('sel_multiselect', None)
+        st.session_state['_pdf_sig'] = pdf_sig
+        st.session_state['_dirty'] = True
 
+# '_blocks_version' cresce a ogni sostituzione di 'blocks' e fa da chiave per le cache derivate
 blocks = st.session_state['blocks']
 selected_chars = set(st.session_state.get('selected_chars', []))
 
 if 'tap_uri' not in st.session_state:
-    st.session_state['tap_uri'] = tap_wav_data_uri(duration_ms=1800)
+    st.session_state['tap_uri'] = tap_data_uri(duration_ms=1800)
 
 tap_uri = st.session_state['tap_uri']
 
-if not blocks:
+if not blocks.texts:
     st.info('Carica il PDF oppure ripristina la cache salvata. I personaggi non si modificano; abilita interazione dal selettore qui sotto.')
 else:
     # Selettore personaggi
     st.subheader('Seleziona i personaggi da rendere interattivi')
-    chars = [b['character'] for b in blocks if b['character'].strip().upper() != 'SCENA']
-    uniq = sorted(dict.fromkeys(chars))
-    cols_sel = st.columns(3)
-    any_changed = False
-    for idx, name in enumerate(uniq):
-        col = cols_sel[idx % 3]
-        with col:
-            key = f'sel_{idx}'
-            default = name in selected_chars
-            val = st.checkbox(name, value=default, key=key)
-            if val and name not in selected_chars:
-                selected_chars.add(name); any_changed = True
-            if (not val) and name in selected_chars:
-                selected_chars.remove(name); any_changed = True
-    if any_changed:
+    # Elenco personaggi ricalcolato solo quando cambia il copione
+    sig = st.session_state.get('_blocks_version', 0)
+    if st.session_state.get('_chars_sig') != sig:
+        chars = [c for c in blocks.characters if c.strip().upper() != 'SCENA']
+        st.session_state['_uniq_chars'] = sorted(dict.fromkeys(chars))
+        st.session_state['_chars_sig'] = sig
+    uniq = st.session_state['_uniq_chars']
+    # Stato del widget inizializzato una sola volta per copione: passare default= a ogni
+    # run cambierebbe l'ID del widget e farebbe perdere la selezione appena fatta
+    if 'sel_multiselect' not in st.session_state or st.session_state.get('_sel_sig') != sig:
+        st.session_state['sel_multiselect'] = [name for name in uniq if name in selected_chars]
+        st.session_state['_sel_sig'] = sig
+    new_sel = st.multiselect('Personaggi interattivi', uniq, key='sel_multiselect')
+    new_set = set(new_sel)
+    if new_set != selected_chars:
+        selected_chars = new_set
         st.session_state['selected_chars'] = sorted(selected_chars)
-        save_cache(blocks, st.session_state['selected_chars'])
+        st.session_state['_dirty'] = True
 
     st.divider()
 
     # Render blocchi con per-row Play/Stop e anchor per navigazione
-    if 'edit_flags' not in st.session_state or len(st.session_state['edit_flags']) != len(blocks):
-        st.session_state['edit_flags'] = [False]*len(blocks)
-
-    # Add CSS for anchors
-    st.markdown("""
-<style>
-  div[id^='anchor_'] { scroll-margin-top: 96px; }
-</style>
-""", unsafe_allow_html=True)
-    
-    for i, b in enumerate(blocks):
-        char = b['character']
-        is_scene = char.strip().upper() == 'SCENA'
-        selected = (char in selected_chars) and (not is_scene)
+    if 'edit_flags' not in st.session_state or len(st.session_state['edit_flags']) != len(blocks.texts):
+        st.session_state['edit_flags'] = [False]*len(blocks.texts)
 
-        # Create anchor only for interactive rows (with Play button)
-        if selected:
-            st.markdown("<div id='anchor_{}'></div>".format(i), unsafe_allow_html=True)
+    # Markup dei blocchi (normale, selezionato, attributo data-text) calcolato una volta e ricalcolato alla modifica
+    sig = st.session_state.get('_blocks_version', 0)
+    if st.session_state.get('_rendered_sig') != sig:
+        st.session_state['_rendered'] = [None]*len(blocks.texts)
+        st.session_state['_rendered_sig'] = sig
+    rendered = st.session_state['_rendered']
+    for i, text in enumerate(blocks.texts):
+        if rendered[i] is None:
+            rendered[i] = _render_block(text)
 
-        cols = st.columns([1.2, 3, 1])
-        with cols[0]:
-            st.text_input('Personaggio', value=char, key=f'char_static_{i}', disabled=True)
-        with cols[1]:
-            if not selected:
-                st.markdown("<div style='white-space:pre-wrap;border:1px solid #ddd;padding:8px;border-radius:6px;background:#fafafa'>{}</div>".format(b['text'].replace('<','&lt;').replace('>','&gt;')), unsafe_allow_html=True)
-            else:
-                if not st.session_state['edit_flags'][i]:
-                    st.markdown("<div style='white-space:pre-wrap;border:1px solid #ddd;padding:8px;border-radius:6px;background:#fffef8'>{}</div>".format(b['text'].replace('<','&lt;').replace('>','&gt;')), unsafe_allow_html=True)
-                    if st.button('Modifica', key=f'btnedit_{i}'):
-                        st.session_state['edit_flags'][i] = True
-                else:
-                    new_text = st.text_area('Modifica battuta', value=b['text'], height=140, key=f'text_edit_{i}')
-                    c1, c2 = st.columns(2)
-                    with c1:
-                        if st.button('Salva', key=f'btnsave_{i}'):
-                            blocks[i]['text'] = new_text
-                            st.session_state['edit_flags'][i] = False
-                            save_cache(blocks, sorted(selected_chars))
-                            st.toast('Battuta salvata')
-                    with c2:
-                        if st.button('Annulla', key=f'btncancel_{i}'):
-                            st.session_state['edit_flags'][i] = False
-        with cols[2]:
-            if selected:
-                use_tap = st.checkbox('Tap', value=True, key=f'tap_{i}', help='Riproduci suono tastiera prima della voce')
-                text_safe = blocks[i]['text'].replace("'", "\\'").replace("\n", " ")
-                tap_src = tap_uri if use_tap else ''
-                
-                # Render button with st.components.v1.html for proper isolation
-                button_html = f"""
-<button id='btn_{i}' style='padding:6px 12px; cursor:pointer; border:1px solid #ccc; border-radius:4px; background:#f0f0f0; min-width:70px;'>Play</button>
-<audio id='tap_{i}' src='{tap_src}' preload='auto'></audio>
+    # Player unico: un solo iframe gestisce i Play di tutte le righe (click delegati
+    # sul documento padre) e le frecce di navigazione, invece di un iframe per riga
+    player_html = f"""
+<audio id='tap_global' src='{tap_uri}' preload='auto'></audio>
 <script>
 (function() {{
-    const btn = document.getElementById('btn_{i}');
-    const tap = document.getElementById('tap_{i}');
-    const text = '{text_safe}';
-    let playing = false;
-    
+    const parentWin = window.parent || window;
+    const parentDoc = parentWin.document;
+    const synth = window.speechSynthesis;
+    const tap = document.getElementById('tap_global');
+    let current = null;
+
     function selectVoice() {{
-        const voices = window.speechSynthesis.getVoices() || [];
+        const voices = synth.getVoices() || [];
         for (let v of voices) {{
             const name=(v.name||'').toLowerCase(); const vg=(v.lang||'').toLowerCase();
             if (vg.startsWith('it') && (name.includes('female')||name.includes('fem')||name.includes('alice')||name.includes('donna'))) return v;
@@ -282,45 +390,54 @@ else:
         for (let v of voices) {{ if ((v.lang||'').toLowerCase().startsWith('it')) return v; }}
         return null;
     }}
-    
+    let voice = selectVoice();
+    synth.onvoiceschanged = function() {{ voice = selectVoice(); }};
+
+    function speak(utter) {{
+        try {{ synth.cancel(); }} catch(e) {{}}
+        synth.speak(utter);
+    }}
+
     function stopAll() {{
-        try {{ window.speechSynthesis.cancel(); }} catch(e) {{}}
-        if (tap) {{ try {{ tap.pause(); tap.currentTime = 0; }} catch(e) {{}} }}
-        playing = false;
-        if (btn) btn.textContent = 'Play';
+        try {{ synth.cancel(); }} catch(e) {{}}
+        tap.onended = null; tap.onerror = null;
+        try {{ tap.pause(); tap.currentTime = 0; }} catch(e) {{}}
+        if (current) current.textContent = 'Play';
+        current = null;
     }}
-    
-    if (btn) {{
-        btn.onclick = function() {{
-            if (playing) {{ stopAll(); return; }}
-            playing = true;
-            btn.textContent = 'Stop';
-            
-            const utter = new SpeechSynthesisUtterance(text);
-            utter.lang = 'it-IT'; utter.rate = 1;
-            const v = selectVoice(); if (v) utter.voice = v;
-            
-            utter.onend = stopAll;
-            utter.onerror = stopAll;
-            
-            if (tap && tap.src) {{
-                tap.onended = function() {{ try {{ window.speechSynthesis.cancel(); }} catch(e) {{}} window.speechSynthesis.speak(utter); }};
-                tap.onerror = function() {{ try {{ window.speechSynthesis.cancel(); }} catch(e) {{}} window.speechSynthesis.speak(utter); }};
-                tap.play().catch(function() {{ try {{ window.speechSynthesis.cancel(); }} catch(e) {{}} window.speechSynthesis.speak(utter); }});
-            }} else {{
-                try {{ window.speechSynthesis.cancel(); }} catch(e) {{}} window.speechSynthesis.speak(utter);
-            }}
-        }};
+
+    function onClick(e) {{
+        const btn = e.target.closest ? e.target.closest('[data-play]') : null;
+        if (!btn) return;
+        if (current === btn) {{ stopAll(); return; }}
+        stopAll();
+        current = btn;
+        btn.textContent = 'Stop';
+
+        const utter = new SpeechSynthesisUtterance(btn.dataset.text || '');
+        utter.lang = 'it-IT'; utter.rate = 1;
+        if (voice) utter.voice = voice;
+        utter.onend = utter.onerror = function() {{ if (current === btn) stopAll(); }};
+
+        if (btn.dataset.tap === '1' && tap.src) {{
+            tap.onended = function() {{ speak(utter); }};
+            tap.onerror = function() {{ speak(utter); }};
+            tap.play().catch(function() {{ speak(utter); }});
+        }} else {{
+            speak(utter);
+        }}
     }}
+
+    // un rerun può ricreare l'iframe: rimuovi il listener della versione precedente
+    if (parentWin.__copioneOnClick) parentDoc.removeEventListener('click', parentWin.__copioneOnClick);
+    parentWin.__copioneOnClick = onClick;
+    parentDoc.addEventListener('click', onClick);
 }})();
 </script>
 """
-                st.components.v1.html(button_html, height=60)
-        
-        st.divider()
 
-        # Navigation - inject buttons into parent document to avoid iframe constraints
-        nav_html = """
+    # Navigation - inject buttons into parent document to avoid iframe constraints
+    nav_html = """
 <script>
 (function(){
     const parentDoc = window.parent?.document || document;
@@ -350,16 +467,66 @@ else:
 })();
 </script>
 """
-        st.components.v1.html(nav_html, height=0)
+    st.components.v1.html(player_html + nav_html, height=0)
+
+    # Add CSS for anchors
+    st.markdown("""
+<style>
+  div[id^='anchor_'] { scroll-margin-top: 96px; }
+</style>
+""", unsafe_allow_html=True)
+    
+    for i, char in enumerate(blocks.characters):
+        is_scene = char.strip().upper() == 'SCENA'
+        selected = (char in selected_chars) and (not is_scene)
+
+        # Create anchor only for interactive rows (with Play button)
+        if selected:
+            st.markdown("<div id='anchor_{}'></div>".format(i), unsafe_allow_html=True)
+
+        cols = st.columns([1.2, 3, 1])
+        with cols[0]:
+            st.text_input('Personaggio', value=char, key=f'char_static_{i}', disabled=True)
+        with cols[1]:
+            if not selected:
+                st.markdown(rendered[i][0], unsafe_allow_html=True)
+            else:
+                if not st.session_state['edit_flags'][i]:
+                    st.markdown(rendered[i][1], unsafe_allow_html=True)
+                    if st.button('Modifica', key=f'btnedit_{i}'):
+                        st.session_state['edit_flags'][i] = True
+                else:
+                    new_text = st.text_area('Modifica battuta', value=blocks.texts[i], height=140, key=f'text_edit_{i}')
+                    c1, c2 = st.columns(2)
+                    with c1:
+                        if st.button('Salva', key=f'btnsave_{i}'):
+                            blocks.texts[i] = new_text
+                            rendered[i] = _render_block(new_text)
+                            st.session_state['edit_flags'][i] = False
+                            st.session_state['_dirty'] = True
+                            st.toast('Battuta salvata')
+                    with c2:
+                        if st.button('Annulla', key=f'btncancel_{i}'):
+                            st.session_state['edit_flags'][i] = False
+        with cols[2]:
+            if selected:
+                use_tap = st.checkbox('Tap', value=True, key=f'tap_{i}', help='Riproduci suono tastiera prima della voce')
+                st.markdown(_PLAY_HTML.format('1' if use_tap else '0', rendered[i][2]), unsafe_allow_html=True)
+
+        st.divider()
     st.divider()
     colx, coly = st.columns(2)
     with colx:
         if st.button('Scarica copione TXT'):
-            txt = io.StringIO()
-            for b in blocks:
-                txt.write(f"{b['character']}:\n{b['text']}\n\n")
-            st.download_button('Scarica TXT', data=txt.getvalue(), file_name='copione_modificato.txt')
+            txt = ''.join(f"{char}:\n{text}\n\n" for char, text in zip(blocks.characters, blocks.texts))
+            st.download_button('Scarica TXT', data=txt, file_name='copione_modificato.txt')
     with coly:
         if st.button('Scarica copione JSON'):
-            data = json.dumps(blocks, ensure_ascii=False, indent=2)
+            data = orjson.dumps(_blocks_to_dicts(blocks), option=orjson.OPT_INDENT_2)
             st.download_button('Scarica JSON', data=data, file_name='copione_modificato.json', mime='application/json')
+
+# Salvataggio cache una sola volta per rerun, solo se qualcosa è cambiato
+if st.session_state.pop('_dirty', False):
+    st.session_state['_saved_digest'] = save_cache(st.session_state['blocks'],
+                                                   st.session_state.get('selected_chars', []),
+                                                   st.session_state.get('_saved_digest'))